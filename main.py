@@ -4,23 +4,28 @@ Movie poster every 5 h, no duplicates within the same week or month.
 Automatically prevents reposts from the previous week.
 """
 import os
-import json
+import sys
+import orjson
 import random
+import functools
+import string
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
-import cloudinary
-import cloudinary.uploader as uploader
-import google.generativeai as genai
 
 # --------------------------------------------------------------
-TMDB_KEY   = os.getenv("TMDB_API_KEY")
-CLOUD_NAME = os.getenv("CLOUDINARY_CLOUD_NAME")
-CL_KEY     = os.getenv("CLOUDINARY_API_KEY")
-CL_SECRET  = os.getenv("CLOUDINARY_API_SECRET")
-FB_TOKEN   = os.getenv("FACEBOOK_PAGE_ACCESS_TOKEN")
-FB_PAGE    = os.getenv("FACEBOOK_PAGE_ID")
-
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Fail fast on a missing secret instead of deep inside a request.
+REQUIRED = ("TMDB_API_KEY", "FACEBOOK_PAGE_ACCESS_TOKEN",
+            "FACEBOOK_PAGE_ID", "GEMINI_API_KEY")
+_missing = [k for k in REQUIRED if not os.environ.get(k)]
+if _missing:
+    sys.exit(f"Missing environment variables: {', '.join(_missing)}")
+
+TMDB_KEY, FB_TOKEN, FB_PAGE, GEMINI_KEY = (os.environ[k] for k in REQUIRED)
+
 MODEL = "gemini-2.5-flash"
 
 GENRE_MAP = {28:"Action",12:"Adventure",16:"Animation",35:"Comedy",
@@ -29,112 +34,217 @@ GENRE_MAP = {28:"Action",12:"Adventure",16:"Animation",35:"Comedy",
              9648:"Mystery",10749:"Romance",878:"Sci-Fi",
              53:"Thriller",10752:"War",37:"Western"}
 
+CAPTION_PROMPT = string.Template(
+    "Write a short structured Facebook post with emojis and line breaks (do not add intros like Here's your post).\n"
+    "Format:\n"
+    "🎬 Title\n\n"
+    "⭐ Rating\n"
+    "📅 Release Date\n\n"
+    "📖 Short Hook (1-2 sentences)\n"
+    "Include hashtags at the end.\n\n"
+    "Title: $title\n\n"
+    "Genres: $genres\n"
+    "Rating: $rating/10\n"
+    "Release: $release\n\n"
+    "Synopsis: $synopsis..."
+)
+
 CACHE_FILE = "posted_cache.json"
+TRENDING_CACHE = "trending_cache.json"
+TRENDING_TTL = 6 * 3600  # trending/day changes at most once a day
+TRENDING_PAGES = (1, 2, 3)  # well under TMDB's rate limit
+CAPTION_TTL = 30 * 24 * 3600
+PAYLOAD_FILE = "payloads.json"
+PAYLOAD_TTL = 7 * 24 * 3600
+
+FB_RETRY_STATUS = {429, 500, 502, 503}
+FB_RETRIES = 3
+
+def week_key(dt):
+    """ISO year-week key, e.g. "2025-01"; unlike %Y-%U it never splits a week at New Year."""
+    y, w, _ = dt.isocalendar()
+    return f"{y}-{w:02d}"
+
+# Computed once so load and save agree even across a week boundary.
+NOW = datetime.utcnow()
+MONTH_KEY = NOW.strftime("%Y-%m")
+WEEK_KEY = week_key(NOW)
+LAST_WEEKS = [week_key(NOW - timedelta(days=7 * i)) for i in (1, 2)]
 # --------------------------------------------------------------
 
-cloudinary.config(
-    cloud_name=CLOUD_NAME,
-    api_key=CL_KEY,
-    api_secret=CL_SECRET,
+# One keep-alive session for TMDB and Facebook, with retry/backoff on
+# rate limits and transient server errors. urllib3 does not retry POSTs on
+# status, so post_to_facebook runs its own backoff loop.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=5, backoff_factor=1,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True),
 )
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# The Gemini SDK (grpc/protobuf) is imported on first use so runs that exit
+# with no new movie skip its import cost.
+@functools.lru_cache(maxsize=1)
+def gemini_model():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_KEY)
+    return genai.GenerativeModel(MODEL)
 
 # ------------------ Cache Management -------------------------
+def write_json(path, payload):
+    """Write JSON via a temp file + rename so an interrupted run never leaves a truncated file."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(payload))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
 def load_posted():
-    """Return sets of TMDB IDs already posted this week and month, including last 2 weeks."""
+    """Return sets of TMDB IDs already posted this week and month, including last 2 weeks,
+    plus the raw cache dict so save_posted can update it without re-reading the file."""
     week_ids, month_ids = set(), set()
-    now = datetime.utcnow()
-    month_key = now.strftime("%Y-%m")
-    current_week_key = now.strftime("%Y-%U")
-
-    # Prepare last 2 week keys
-    last_weeks = [(now - timedelta(days=7 * i)).strftime("%Y-%U") for i in range(1, 3)]
-
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            data = json.load(f)
 
-        # Month IDs
-        if data.get("month", {}).get("key") == month_key:
-            month_ids = set(data["month"].get("ids", []))
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return week_ids, month_ids, {}
 
-        # Week IDs: current week + last 2 weeks
-        week_data = data.get("week", {})
-        for wk_key in [current_week_key] + last_weeks:
-            ids = week_data.get(wk_key, [])
-            week_ids.update(ids)
+    # Month IDs
+    if data.get("month", {}).get("key") == MONTH_KEY:
+        month_ids = set(map(int, data["month"].get("ids", [])))
 
-    return week_ids, month_ids
+    # Week IDs: current week + last 2 weeks
+    week_data = data.get("week", {})
+    for wk_key in [WEEK_KEY] + LAST_WEEKS:
+        ids = week_data.get(wk_key, [])
+        week_ids.update(map(int, ids))
 
-def save_posted(week_ids, month_ids):
-    """Save sets of IDs with the current week and month, keeping only last 3 weeks."""
-    now = datetime.utcnow()
-    month_key = now.strftime("%Y-%m")
-    current_week_key = now.strftime("%Y-%U")
+    return week_ids, month_ids, data
 
-    # Load old cache if exists
-    cache = {}
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            cache = json.load(f)
+def save_posted(week_ids, month_ids, cache):
+    """Save sets of IDs with the current week and month, keeping only last 3 weeks.
 
+    `cache` is the raw dict returned by load_posted and is updated in place.
+    """
     # Update month
-    cache["month"] = {"key": month_key, "ids": list(month_ids)}
+    cache["month"] = {"key": MONTH_KEY, "ids": list(month_ids)}
 
     # Update week
     old_week_data = cache.get("week", {})
-    # Keep only last 2 old weeks + current
-    last_weeks = [(now - timedelta(days=7 * i)).strftime("%Y-%U") for i in range(1, 3)]
-    new_week_data = {wk: old_week_data.get(wk, []) for wk in last_weeks}
-    new_week_data[current_week_key] = list(week_ids)
+    # Keep only last 2 old weeks + current. week_ids also holds the last 2
+    # weeks' IDs; leave those in their own buckets so they age out.
+    new_week_data = {wk: old_week_data.get(wk, []) for wk in LAST_WEEKS}
+    earlier = {int(i) for wk in LAST_WEEKS for i in new_week_data[wk]}
+    new_week_data[WEEK_KEY] = list(week_ids - earlier)
     cache["week"] = new_week_data
 
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+    # Drop captions older than the TTL
+    now = time.time()
+    cache["captions"] = {mid: c for mid, c in cache.get("captions", {}).items()
+                         if now - c["ts"] < CAPTION_TTL}
+
+    write_json(CACHE_FILE, cache)
+
+def load_payloads():
+    """Return ready-to-post payloads from failed runs, keyed by TMDB ID, dropping stale ones."""
+    try:
+        with open(PAYLOAD_FILE, "rb") as f:
+            payloads = orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    now = time.time()
+    return {mid: p for mid, p in payloads.items() if now - p["ts"] < PAYLOAD_TTL}
 
 
 # ------------------ Movie Selection -------------------------
+def fetch_trending_page(url):
+    """Return the results of one TMDB trending page, raising on an HTTP error."""
+    r = SESSION.get(url, timeout=10)
+    r.raise_for_status()
+    return r.json().get("results", [])
+
 def trending_movies():
-    url = f"https://api.themoviedb.org/3/trending/movie/day?api_key={TMDB_KEY}"
-    data = requests.get(url, timeout=10).json()
-    results = data.get("results", [])
+    """Return today's trending movies, served from disk while the cache is fresh."""
+    results = None
+    try:
+        with open(TRENDING_CACHE, "rb") as f:
+            cached = orjson.loads(f.read())
+    except FileNotFoundError:
+        cached = {}
+    if time.time() - cached.get("ts", 0) < TRENDING_TTL:
+        results = cached.get("results")
+
+    if results is None:
+        base = f"https://api.themoviedb.org/3/trending/movie/day?api_key={TMDB_KEY}"
+        urls = [f"{base}&page={p}" for p in TRENDING_PAGES]
+        with ThreadPoolExecutor(len(urls)) as ex:
+            pages = list(ex.map(fetch_trending_page, urls))
+        results = [m for page in pages for m in page]
+        # Only cache a complete fetch; a short list would stick for the whole TTL
+        if all(pages):
+            write_json(TRENDING_CACHE, {"ts": time.time(), "results": results})
+
     random.shuffle(results)  # shuffle to reduce repeated picks
     return results
 
-def choose_movie(movies, week_ids, month_ids):
-    """Return first unseen movie, else None."""
+def choose_movie(movies, week_ids, month_ids, pending=()):
+    """Return first unseen movie, preferring one with a saved payload in `pending`, else None."""
     print("Already posted this week:", week_ids)
     print("Already posted this month:", month_ids)
+    first = None
     for m in movies:
-        mid = str(m["id"])
+        mid = m["id"]
         print("Considering movie:", mid, m["title"])
-        if mid not in week_ids and mid not in month_ids:
-            print("Selected:", mid, m["title"])
+        if mid in week_ids or mid in month_ids:
+            continue
+        if str(mid) in pending:
+            print("Selected (saved payload):", mid, m["title"])
             return m
-    return None
+        if first is None:
+            first = m
+    if first:
+        print("Selected:", first["id"], first["title"])
+    return first
 
 # ------------------ Poster & Caption ------------------------
 def generate_poster(movie):
+    """Return the TMDB poster URL: a static CDN asset with nothing rendered on fetch."""
     return f"https://image.tmdb.org/t/p/w500{movie['poster_path']}"
 
-def generate_caption(movie):
-    genres = ", ".join(GENRE_MAP.get(g, "") for g in movie.get("genre_ids", []))
-    prompt = (
-        f"Write a short structured Facebook post with emojis and line breaks (do not add intros like Here's your post).\n"
-        f"Format:\n"
-        f"🎬 Title\n\n"
-        f"⭐ Rating\n"
-        f"📅 Release Date\n\n"
-        f"📖 Short Hook (1-2 sentences)\n"
-        f"Include hashtags at the end.\n\n"
-        f"Title: {movie['title']}\n\n"
-        f"Genres: {genres}\n"
-        f"Rating: {movie['vote_average']}/10\n"
-        f"Release: {movie.get('release_date', 'TBA')}\n\n"
-        f"Synopsis: {movie['overview'][:150]}..."
+def warm_poster(img_url):
+    """HEAD the image so the CDN edge has it cached before Facebook fetches it."""
+    try:
+        SESSION.head(img_url, timeout=5)
+    except requests.exceptions.RequestException as e:
+        print("Poster warm-up failed:", e)
+
+def generate_caption(movie, cache):
+    """Return a caption for the movie, reusing one from the cache if it is recent enough."""
+    captions = cache.setdefault("captions", {})
+    key = str(movie["id"])
+    hit = captions.get(key)
+    if hit and time.time() - hit["ts"] < CAPTION_TTL:
+        print("Using cached caption for", key)
+        return hit["text"]
+
+    genres = ", ".join([GENRE_MAP[g] for g in movie.get("genre_ids", ()) if g in GENRE_MAP])
+    prompt = CAPTION_PROMPT.substitute(
+        title=movie["title"],
+        genres=genres,
+        rating=movie["vote_average"],
+        release=movie.get("release_date", "TBA"),
+        synopsis=movie["overview"][:150],
     )
-    model = genai.GenerativeModel(MODEL)
-    text = model.generate_content(prompt).text.strip()
-    return text.replace("\\n", "\n")
+    text = gemini_model().generate_content(prompt).text.strip()
+    text = text.replace("\\n", "\n")
+    captions[key] = {"text": text, "ts": time.time()}
+    return text
 
 # ------------------ Facebook Posting ------------------------
 def post_to_facebook(img_url, caption):
@@ -144,32 +254,65 @@ def post_to_facebook(img_url, caption):
         "url": img_url,
         "access_token": FB_TOKEN
     }
-    r = requests.post(url, data=payload, timeout=10)
-    try:
-        r.raise_for_status()
-    except requests.exceptions.HTTPError:
-        print("Facebook API error:", r.text)
-        raise
-    return str(r.json().get("id"))
+    for attempt in range(FB_RETRIES + 1):
+        r = SESSION.post(url, data=payload, timeout=10)
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            print("Facebook API error:", r.text)
+            if r.status_code not in FB_RETRY_STATUS or attempt == FB_RETRIES:
+                raise
+            time.sleep(min(60, 2 ** attempt))
+            continue
+        return str(r.json().get("id"))
 
 # ------------------ Main -------------------------------------
 def main():
-    week_ids, month_ids = load_posted()
-    movies = trending_movies()
-    movie = choose_movie(movies, week_ids, month_ids)
-    if not movie:
-        print("No new movie to post this cycle.")
-        return
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        # Disk reads and TMDB fetch are independent; so are caption and warm-up.
+        posted = ex.submit(load_posted)
+        pending = ex.submit(load_payloads)
+        movies = ex.submit(trending_movies)
+        week_ids, month_ids, cache = posted.result()
+        payloads = pending.result()
+        movie = choose_movie(movies.result(), week_ids, month_ids, payloads)
+        if not movie:
+            print("No new movie to post this cycle.")
+            return
 
-    poster_url = generate_poster(movie)
-    caption = generate_caption(movie)
-    fb_id = post_to_facebook(poster_url, caption)
+        # Resume a payload left by a failed post, if any
+        key = str(movie["id"])
+        ready = payloads.get(key)
+        if ready:
+            print("Resuming saved payload for", key)
+            poster_url, caption = ready["poster"], ready["caption"]
+            cache.setdefault("captions", {})[key] = {"text": caption, "ts": time.time()}
+            warm_poster(poster_url)
+        else:
+            poster_url = generate_poster(movie)
+            caption = ex.submit(generate_caption, movie, cache)
+            warm = ex.submit(warm_poster, poster_url)
+            warm.result()
+            caption = caption.result()
+
+    try:
+        fb_id = post_to_facebook(poster_url, caption)
+    except requests.exceptions.HTTPError as e:
+        # Facebook rejected the post, so keep the payload for the next run to
+        # post without calling Gemini. Timeouts and connection errors are not
+        # saved: the photo may have gone through before the reply was lost.
+        if e.response is not None and e.response.status_code >= 400 and key not in payloads:
+            payloads[key] = {"poster": poster_url, "caption": caption, "ts": time.time()}
+            write_json(PAYLOAD_FILE, payloads)
+        raise
+    if payloads.pop(key, None):
+        write_json(PAYLOAD_FILE, payloads)
 
     # mark as posted
-    mid = str(movie["id"])
+    mid = movie["id"]
     week_ids.add(mid)
     month_ids.add(mid)
-    save_posted(week_ids, month_ids)
+    save_posted(week_ids, month_ids, cache)
     print("Posted:", fb_id)
 
 if __name__ == "__main__":